@@ -8,160 +8,223 @@
 import sqlite3
 import hashlib
 import csv
-import os
+import atexit
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
 DB_FILE = "bank.db"
 CSV_LOG = "transactions.csv"
 
+# Single shared connection, opened by init_db() and reused by every helper.
+_CONN = None
+
+# ---- SQL statements (fixed text so sqlite3's statement cache can reuse them) ----
+_Q_GET_USER = "SELECT id, username, pin_hash, name FROM users WHERE username = ?"
+_Q_INS_USER = "INSERT INTO users (username, pin_hash, name) VALUES (?, ?, ?)"
+_Q_INS_ACCOUNT = "INSERT INTO accounts (user_id, checking, savings) VALUES (?, ?, ?)"
+_Q_INS_ACCOUNT_BY_NAME = ("INSERT INTO accounts (user_id, checking, savings) "
+                          "SELECT id, ?, ? FROM users WHERE username = ?")
+_Q_GET_BAL_C = "SELECT checking FROM accounts WHERE user_id = ?"
+_Q_GET_BAL_S = "SELECT savings FROM accounts WHERE user_id = ?"
+_Q_UPD_C = "UPDATE accounts SET checking = ? WHERE user_id = ?"
+_Q_UPD_S = "UPDATE accounts SET savings = ? WHERE user_id = ?"
+_Q_INS_TXN = """
+    INSERT INTO transactions (user_id, account_type, old_balance, amount, new_balance, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+_Q_COUNT_USERS = "SELECT COUNT(*) FROM users"
+_Q_DEL_TXNS = "DELETE FROM transactions WHERE user_id = ?"
+_Q_DEL_ACCOUNT = "DELETE FROM accounts WHERE user_id = ?"
+_Q_DEL_USER = "DELETE FROM users WHERE id = ?"
+# Comparisons stay in SQL so a NULL balance simply never counts as above average.
+_Q_STATS = """
+    SELECT u.username,
+           a.checking > AVG(a.checking) OVER (), a.savings > AVG(a.savings) OVER (),
+           AVG(a.checking) OVER (), AVG(a.savings) OVER ()
+    FROM users u
+    JOIN accounts a ON u.id = a.user_id
+"""
+
+_BAL_Q = {"C": _Q_GET_BAL_C, "S": _Q_GET_BAL_S}
+_UPD_Q = {"C": _Q_UPD_C, "S": _Q_UPD_S}
+
+# The audit log is opened once and kept open behind an 8 KB buffer.
+_csv_file = None
+_csv_writer = None
+
+# Characters that would need CSV quoting; usernames containing them are rejected.
+_CSV_UNSAFE = frozenset(',"\r\n')
+
+# [time.time() of last refresh, cached ISO timestamp], see _now_iso().
+_ts_cache = [0.0, ""]
+
 
 # -------------------- Database Setup --------------------
 
+@contextmanager
+def transaction(immediate=False):
+    """Runs the enclosed statements in one BEGIN...COMMIT, rolling back on error.
+
+    immediate=True takes the write lock up front, so rows read inside the
+    block cannot change before they are written back.
+    """
+    cur = _CONN.cursor()
+    cur.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield cur
+        cur.execute("COMMIT")
+    except BaseException:
+        # SQLite may already have rolled back on its own (e.g. on some I/O errors).
+        if _CONN.in_transaction:
+            cur.execute("ROLLBACK")
+        raise
+
+
 def init_db():
-    """Initializes the SQLite database and creates tables if they don't exist."""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        pin_hash TEXT NOT NULL,
-        name TEXT NOT NULL
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS accounts (
-        user_id INTEGER PRIMARY KEY,
-        checking REAL DEFAULT 0,
-        savings REAL DEFAULT 0,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        account_type TEXT NOT NULL,
-        old_balance REAL NOT NULL,
-        amount REAL NOT NULL,
-        new_balance REAL NOT NULL,
-        timestamp TEXT NOT NULL,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )
-    """)
-
-    # ---- Add sample test accounts if database is empty ----
-    cur.execute("SELECT COUNT(*) FROM users")
-    user_count = cur.fetchone()[0]
-
-    if user_count == 0:
-        print("🧪 Adding 3 sample test accounts...")
-
-        sample_users = [
-            ("alice", hashlib.sha256("1111".encode()).hexdigest(), "Alice Smith", 1500.00, 500.00),
-            ("bob", hashlib.sha256("2222".encode()).hexdigest(), "Bob Johnson", 2500.00, 1000.00),
-            ("carla", hashlib.sha256("3333".encode()).hexdigest(), "Carla Gomez", 300.00, 700.00),
-        ]
-
-        for username, pin_hash, name, checking, savings in sample_users:
-            cur.execute("INSERT INTO users (username, pin_hash, name) VALUES (?, ?, ?)", (username, pin_hash, name))
-            user_id = cur.lastrowid
-            cur.execute("INSERT INTO accounts (user_id, checking, savings) VALUES (?, ?, ?)",
-                        (user_id, checking, savings))
-
-        print("✅ Sample accounts created: alice (1111), bob (2222), carla (3333)")
-
-    conn.commit()
-    conn.close()
+    """Opens the shared SQLite connection and creates tables if they don't exist."""
+    global _CONN
+    _CONN = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False,
+                            cached_statements=256)
+    _CONN.execute("PRAGMA journal_mode=WAL")
+    _CONN.execute("PRAGMA synchronous=NORMAL")
+    _CONN.execute("PRAGMA temp_store=MEMORY")
+    atexit.register(_CONN.close)
+
+    with transaction() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            pin_hash TEXT NOT NULL,
+            name TEXT NOT NULL
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            user_id INTEGER PRIMARY KEY,
+            checking REAL DEFAULT 0,
+            savings REAL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            account_type TEXT NOT NULL,
+            old_balance REAL NOT NULL,
+            amount REAL NOT NULL,
+            new_balance REAL NOT NULL,
+            timestamp TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        """)
+
+        # Serves per-user deletes and newest-first history lookups.
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_txn_user_ts ON transactions (user_id, timestamp DESC)")
+
+        # ---- Add sample test accounts if database is empty ----
+        cur.execute(_Q_COUNT_USERS)
+        user_count = cur.fetchone()[0]
+
+        if user_count == 0:
+            print("🧪 Adding 3 sample test accounts...")
+
+            sample_users = [
+                ("alice", hash_pin("1111"), "Alice Smith", 1500.00, 500.00),
+                ("bob", hash_pin("2222"), "Bob Johnson", 2500.00, 1000.00),
+                ("carla", hash_pin("3333"), "Carla Gomez", 300.00, 700.00),
+            ]
+
+            cur.executemany(_Q_INS_USER, [(u, p, n) for u, p, n, _, _ in sample_users])
+            cur.executemany(_Q_INS_ACCOUNT_BY_NAME, [(c, s, u) for u, _, _, c, s in sample_users])
+
+            print("✅ Sample accounts created: alice (1111), bob (2222), carla (3333)")
 
 
 # -------------------- Helper Functions --------------------
 
-def hash_pin(pin: str) -> str:
-    return hashlib.sha256(pin.encode()).hexdigest()
+# Every 4-digit PIN's digest, indexed by int(pin). There are only 10,000 PINs,
+# so this is a speed-up for the existing unsalted SHA-256 and NOT a security
+# measure: a table like this is exactly what an attacker would build.
+_PIN_TABLE = [hashlib.sha256(f"{i:04d}".encode(), usedforsecurity=False).digest().hex()
+              for i in range(10000)]
 
 
-def get_user(username):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, pin_hash, name FROM users WHERE username = ?", (username,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+def hash_pin(pin: str) -> str:
+    if len(pin) == 4 and pin.isascii() and pin.isdigit():
+        return _PIN_TABLE[int(pin)]
+    return hashlib.sha256(pin.encode(), usedforsecurity=False).digest().hex()
 
 
-def get_user_by_id(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, pin_hash, name FROM users WHERE id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+def get_user(username):
+    cur = _CONN.cursor()
+    cur.execute(_Q_GET_USER, (username,))
+    return cur.fetchone()
 
 
 def create_user(username, name, pin_hash, checking, savings):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO users (username, pin_hash, name) VALUES (?, ?, ?)", (username, pin_hash, name))
-    user_id = cur.lastrowid
-    cur.execute("INSERT INTO accounts (user_id, checking, savings) VALUES (?, ?, ?)",
-                (user_id, checking, savings))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute(_Q_INS_USER, (username, pin_hash, name))
+        user_id = cur.lastrowid
+        cur.execute(_Q_INS_ACCOUNT, (user_id, checking, savings))
     return user_id
 
 
 def get_balance(user_id, account_type):
-    column = "checking" if account_type == "C" else "savings"
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute(f"SELECT {column} FROM accounts WHERE user_id = ?", (user_id,))
-    balance = cur.fetchone()[0]
-    conn.close()
-    return balance
+    """Returns the balance, or None if the account no longer exists."""
+    cur = _CONN.cursor()
+    cur.execute(_BAL_Q[account_type], (user_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
 
 
 def update_balance(user_id, account_type, new_balance):
-    column = "checking" if account_type == "C" else "savings"
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute(f"UPDATE accounts SET {column} = ? WHERE user_id = ?", (new_balance, user_id))
-    conn.commit()
-    conn.close()
+    _CONN.execute(_UPD_Q[account_type], (new_balance, user_id))
 
 
-def ensure_csv_header():
-    if not os.path.exists(CSV_LOG):
-        with open(CSV_LOG, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["timestamp", "username", "account_type", "old_balance", "amount", "new_balance"])
+def _now_iso():
+    """Returns the current time as an ISO string, reformatted once per wall-clock second."""
+    now = time.time()
+    # int() comparison also refreshes when the wall clock steps backwards.
+    if int(now) != int(_ts_cache[0]):
+        _ts_cache[0] = now
+        _ts_cache[1] = datetime.fromtimestamp(now).isoformat(timespec='seconds')
+    return _ts_cache[1]
+
+
+def _open_csv_log():
+    """Opens the CSV audit log once per process, writing the header if the file is new."""
+    global _csv_file, _csv_writer
+    if _csv_writer is not None:
+        return
+    _csv_file = open(CSV_LOG, 'a', newline='', buffering=8192)
+    _csv_writer = csv.writer(_csv_file)
+    if _csv_file.tell() == 0:
+        _csv_writer.writerow(["timestamp", "username", "account_type", "old_balance", "amount", "new_balance"])
+    atexit.register(_csv_file.close)
 
 
 def log_to_csv(username, account_type, old_balance, amount, new_balance):
-    ensure_csv_header()
-    with open(CSV_LOG, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([datetime.now().isoformat(timespec='seconds'),
-                         username, account_type,
-                         f"{old_balance:.2f}", f"{amount:.2f}", f"{new_balance:.2f}"])
+    """Appends one committed transaction to the audit log and flushes it to disk."""
+    _open_csv_log()
+    if _CSV_UNSAFE.isdisjoint(username):
+        _csv_file.write(f"{_now_iso()},{username},{account_type},"
+                        f"{old_balance:.2f},{amount:.2f},{new_balance:.2f}\r\n")
+    else:
+        # Only usernames created before validation was added can get here.
+        _csv_writer.writerow([_now_iso(), username, account_type,
+                              f"{old_balance:.2f}", f"{amount:.2f}", f"{new_balance:.2f}"])
+    _csv_file.flush()
 
 
 def record_transaction(user_id, account_type, old_balance, amount, new_balance):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO transactions (user_id, account_type, old_balance, amount, new_balance, timestamp)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (user_id, account_type, old_balance, amount, new_balance, datetime.now().isoformat(timespec='seconds')))
-    conn.commit()
-    conn.close()
-
-    user = get_user_by_id(user_id)
-    if user:
-        log_to_csv(user[1], account_type, old_balance, amount, new_balance)
+    """Inserts the transactions row; the caller logs it to CSV once the commit succeeds."""
+    _CONN.execute(_Q_INS_TXN, (user_id, account_type, old_balance, amount, new_balance,
+                               _now_iso()))
 
 
 # -------------------- Core Features --------------------
@@ -172,6 +235,10 @@ def create_account():
         print("Username cannot be empty.")
         return
 
+    if not _CSV_UNSAFE.isdisjoint(username):
+        print("Username cannot contain commas, quotes or line breaks.")
+        return
+
     if get_user(username):
         print("Username already exists.")
         return
@@ -201,14 +268,12 @@ def delete_account():
     if not user:
         print("User not found.")
         return
+    user_id = user[0]
 
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM transactions WHERE user_id = ?", (user[0],))
-    cur.execute("DELETE FROM accounts WHERE user_id = ?", (user[0],))
-    cur.execute("DELETE FROM users WHERE id = ?", (user[0],))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute(_Q_DEL_TXNS, (user_id,))
+        cur.execute(_Q_DEL_ACCOUNT, (user_id,))
+        cur.execute(_Q_DEL_USER, (user_id,))
 
     print("🗑 Account deleted successfully.")
 
@@ -219,9 +284,10 @@ def make_transaction():
     if not user:
         print("No such user.")
         return
+    user_id, username, pin_hash, _ = user
 
     pin = input("Enter your 4-digit PIN: ").strip()
-    if hash_pin(pin) != user[2]:
+    if hash_pin(pin) != pin_hash:
         print("Invalid PIN.")
         return
 
@@ -230,8 +296,11 @@ def make_transaction():
         print("Invalid account type.")
         return
 
-    old_balance = get_balance(user[0], account_type)
-    print(f"Current balance: ${old_balance:,.2f}")
+    balance = get_balance(user_id, account_type)
+    if balance is None:
+        print("No such user.")
+        return
+    print(f"Current balance: ${balance:,.2f}")
 
     try:
         amount = float(input("Enter transaction amount (negative for withdrawal): "))
@@ -239,45 +308,46 @@ def make_transaction():
         print("Invalid amount.")
         return
 
-    if old_balance + amount < 0:
+    # Re-read under the write lock: the balance may have changed while the prompt was open.
+    new_balance = None
+    with transaction(immediate=True):
+        old_balance = get_balance(user_id, account_type)
+        if old_balance is not None and old_balance + amount >= 0:
+            new_balance = old_balance + amount
+            update_balance(user_id, account_type, new_balance)
+            record_transaction(user_id, account_type, old_balance, amount, new_balance)
+
+    if old_balance is None:
+        print("No such user.")
+        return
+    if new_balance is None:
         print("❌ Insufficient funds.")
         return
 
-    new_balance = old_balance + amount
-    update_balance(user[0], account_type, new_balance)
-    record_transaction(user[0], account_type, old_balance, amount, new_balance)
-
+    # Only audit what was actually committed.
+    log_to_csv(username, account_type, old_balance, amount, new_balance)
     print(f"✅ Transaction complete. New balance: ${new_balance:,.2f}")
 
 
 def view_statistics():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT AVG(checking), AVG(savings) FROM accounts")
-    avg_checking, avg_savings = cur.fetchone()
+    cur = _CONN.cursor()
+    cur.execute(_Q_STATS)
+
+    # Stream the rows; every row carries the same averages from the window.
+    avg_checking = avg_savings = None
+    above_checking, above_savings = [], []
+    for username, checking_above, savings_above, avg_checking, avg_savings in cur:
+        if checking_above:
+            above_checking.append(username)
+        if savings_above:
+            above_savings.append(username)
 
     print(f"\n📊 Average Checking: ${avg_checking or 0:,.2f}")
     print(f"📊 Average Savings:  ${avg_savings or 0:,.2f}")
 
-    cur.execute("""
-        SELECT u.username FROM users u
-        JOIN accounts a ON u.id = a.user_id
-        WHERE a.checking > ?
-    """, (avg_checking,))
-    above_checking = [row[0] for row in cur.fetchall()]
-
-    cur.execute("""
-        SELECT u.username FROM users u
-        JOIN accounts a ON u.id = a.user_id
-        WHERE a.savings > ?
-    """, (avg_savings,))
-    above_savings = [row[0] for row in cur.fetchall()]
-
     print("\nUsers above average (Checking):", ", ".join(above_checking) or "None")
     print("Users above average (Savings):", ", ".join(above_savings) or "None")
 
-    conn.close()
-
 
 # -------------------- Main Menu --------------------
 
@@ -291,18 +361,21 @@ def main_menu():
     return input("Enter your choice: ").strip()
 
 
+_ACTIONS = {
+    '1': create_account,
+    '2': delete_account,
+    '3': make_transaction,
+    '4': view_statistics,
+}
+
+
 def main():
     init_db()
     while True:
         choice = main_menu()
-        if choice == '1':
-            create_account()
-        elif choice == '2':
-            delete_account()
-        elif choice == '3':
-            make_transaction()
-        elif choice == '4':
-            view_statistics()
+        action = _ACTIONS.get(choice)
+        if action:
+            action()
         elif choice == '5':
             print("👋 Goodbye!")
             break